@@ -8,12 +8,18 @@ import sys
 import gc
 import inspect
 import threading
+import time
 
 try:
     from Queue import Queue, Full, Empty
 except ImportError:
     from queue import Queue, Full, Empty
 
+try:
+    from queue import SimpleQueue
+except ImportError:
+    SimpleQueue = Queue
+
 from ..wrapper import Value, Type
 from ..client.thread import Context, Disconnected, TimeoutError, RemoteError
 from ..server import Server, StaticProvider
@@ -24,9 +30,57 @@ from .utils import RefTestCase
 
 _log = logging.getLogger(__name__)
 
-class TestGPM(RefTestCase):
+def tearDownModule():
+    # worker threads are shared by all tests in this module.  stop once at the end.
+    _defaultWorkQueue.stop()
+
+class SharedServerTestCase(RefTestCase):
+    """Serve the PVs of one provider from a Server shared by all tests of a class.
+
+    Sub-classes implement setUpFixtures() to create class attributes named in
+    'fixtures', and return the provider to serve.  These are checked for release
+    by tearDownClass().
+    """
     maxDiff = 1000
     timeout = 1.0
+    ref_settle = timeout # shared Server drops client connections asynchronously
+    fixtures = ()
+
+    @classmethod
+    def setUpFixtures(cls):
+        raise NotImplementedError()
+
+    @classmethod
+    def setUpClass(cls):
+        # gc.set_debug(gc.DEBUG_LEAK)
+        super(SharedServerTestCase, cls).setUpClass()
+
+        provider = cls.setUpFixtures()
+
+        cls.server = Server(providers=[provider], isolate=True)
+        cls._conf = cls.server.conf()
+        _log.debug('Server Conf: %s', cls._conf)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        _defaultWorkQueue.sync()
+
+        # no local reference to the handlers may outlive this call
+        cls._assertReleased(('server',) + cls.fixtures, *cls._handlers())
+        super(SharedServerTestCase, cls).tearDownClass()
+
+    @classmethod
+    def _handlers(cls):
+        ret = []
+        for name in cls.fixtures:
+            pv = getattr(cls, name)
+            if isinstance(pv, SharedPV):
+                ret += [pv._whandler, pv._handler]
+        return ret
+
+class TestGPM(SharedServerTestCase):
+    fixtures = ('sprov', 'pv', 'pv2')
 
     class Times2Handler(object):
 
@@ -39,39 +93,32 @@ class TestGPM(RefTestCase):
                 pv.post(V)
             op.done()
 
-    def setUp(self):
-        # gc.set_debug(gc.DEBUG_LEAK)
-        super(TestGPM, self).setUp()
-
-        self.pv = SharedPV(handler=self.Times2Handler(), nt=NTScalar('d'))
-        self.pv2 = SharedPV(handler=self.Times2Handler(), nt=NTScalar('d'), initial=42.0)
-        self.sprov = StaticProvider("serverend")
-        self.sprov.add('foo', self.pv)
-        self.sprov.add('bar', self.pv2)
-
-        self.server = Server(providers=[self.sprov], isolate=True)
-        _log.debug('Server Conf: %s', self.server.conf())
+    @classmethod
+    def setUpFixtures(cls):
+        cls.pv = SharedPV(handler=cls.Times2Handler(), nt=NTScalar('d'))
+        # Times2Handler is stateless, so may be shared
+        cls.pv2 = SharedPV(handler=cls.pv._handler, nt=NTScalar('d'), initial=42.0)
+        cls.sprov = StaticProvider("serverend")
+        cls.sprov.add('foo', cls.pv)
+        cls.sprov.add('bar', cls.pv2)
+        return cls.sprov
 
     def tearDown(self):
-        self.server.stop()
-        _defaultWorkQueue.sync()
-        #self.pv._handler._pv = None
-        R = [weakref.ref(r) for r in (self.server, self.sprov, self.pv, self.pv._whandler, self.pv._handler)]
-        r = None
-        del self.server
-        del self.sprov
-        del self.pv
-        del self.pv2
-        gc.collect()
-        R = [r() for r in R]
-        self.assertListEqual(R, [None] * len(R))
+        # restore initial PV state for the next test
+        self.pv.close(sync=True, timeout=self.timeout)
+        self.pv2.close(sync=True, timeout=self.timeout)
+        self.pv2.open(42.0)
         super(TestGPM, self).tearDown()
 
     def testGet(self):
-        with Context('pva', conf=self.server.conf(), useenv=False) as ctxt:
+        with Context('pva', conf=self._conf, useenv=False) as ctxt:
             _log.debug('Client conf: %s', ctxt.conf())
+            # connect to the server through an open PV, so that a short timeout
+            # below is enough to show that the un-opened PV does not complete.
+            self.assertEqual(ctxt.get('bar'), 42.0)
+
             # PV not yet opened
-            self.assertRaises(TimeoutError, ctxt.get, 'foo', timeout=0.1)
+            self.assertRaises(TimeoutError, ctxt.get, 'foo', timeout=0.005)
 
             self.pv.open(1.0)
 
@@ -83,11 +130,12 @@ class TestGPM(RefTestCase):
 
         C = weakref.ref(ctxt)
         del ctxt
-        gc.collect()
+        if C() is not None:
+            gc.collect() # only needed if a reference cycle remains
         self.assertIsNone(C())
 
     def testPutGet(self):
-        with Context('pva', conf=self.server.conf(), useenv=False) as ctxt:
+        with Context('pva', conf=self._conf, useenv=False) as ctxt:
 
             self.pv.open(1.0)
 
@@ -105,15 +153,16 @@ class TestGPM(RefTestCase):
 
         C = weakref.ref(ctxt)
         del ctxt
-        gc.collect()
+        if C() is not None:
+            gc.collect() # only needed if a reference cycle remains
         self.assertIsNone(C())
 
     def testMonitor(self):
-        with Context('pva', conf=self.server.conf(), useenv=False) as ctxt:
+        with Context('pva', conf=self._conf, useenv=False) as ctxt:
 
             self.pv.open(1.0)
 
-            Q = Queue(maxsize=4)
+            Q = SimpleQueue()
             sub = ctxt.monitor('foo', Q.put, notify_disconnect=True)
 
             V = Q.get(timeout=self.timeout)
@@ -138,18 +187,32 @@ class TestGPM(RefTestCase):
             V = Q.get(timeout=self.timeout)
             self.assertEqual(V, 3.0)
 
+            sub.close() # break Subscription <-> operation cycle
+
         C = weakref.ref(ctxt)
         del ctxt
         del sub
         del Q
-        gc.collect()
+        if C() is not None:
+            gc.collect() # only needed if a reference cycle remains
         self.assertIsNone(C())
 
-class TestRPC(RefTestCase):
-    maxDiff = 1000
-    timeout = 1.0
+class TestRPC(SharedServerTestCase):
+    fixtures = ('provider', 'pv')
     openclose = False
 
+    # request argument types are built once, and reused by each test
+    _RPC_ARGS = NTURI([
+        ('lhs', 'd'),
+        ('rhs', 'd'),
+    ])
+    _RPC_NULL = NTURI([
+        ('null', '?'),
+    ])
+    _RPC_OOPS = NTURI([
+        ('oops', '?'),
+    ])
+
     class Handler:
         def __init__(self, openclose):
             self.openclose = openclose
@@ -172,72 +235,50 @@ class TestRPC(RefTestCase):
             else:
                 op.done(NTScalar('i').wrap(42))
 
-    def setUp(self):
-        super(TestRPC, self).setUp()
-
-        self.pv = SharedPV(nt=NTScalar('i'), handler=self.Handler(self.openclose))
-        self.provider = StaticProvider("serverend")
-        self.provider.add('foo', self.pv)
+    @classmethod
+    def setUpFixtures(cls):
+        cls.pv = SharedPV(nt=NTScalar('i'), handler=cls.Handler(cls.openclose))
+        cls.provider = StaticProvider("serverend")
+        cls.provider.add('foo', cls.pv)
+        return cls.provider
 
     def tearDown(self):
         self.pv.close(sync=True, timeout=self.timeout)
-        self.traceme(self.pv)
-        self.traceme(self.provider)
-        del self.pv
-        del self.provider
         _defaultWorkQueue.sync()
-            
+
         super(TestRPC, self).tearDown()
 
     def test_rpc(self):
-        with Server(providers=[self.provider], isolate=True) as S:
-            with Context('pva', conf=S.conf(), useenv=False) as C:
+        with Context('pva', conf=self._conf, useenv=False) as C:
 
-                args = NTURI([
-                    ('lhs', 'd'),
-                    ('rhs', 'd'),
-                ])
+            # self.pv not open()'d
+            ret = C.rpc('foo', self._RPC_ARGS.wrap('foo', kws={'lhs':1, 'rhs':2}))
+            _log.debug("RET %s", ret)
+            self.assertEqual(ret, 42)
 
-                # self.pv not open()'d
-                ret = C.rpc('foo', args.wrap('foo', kws={'lhs':1, 'rhs':2}))
-                _log.debug("RET %s", ret)
-                self.assertEqual(ret, 42)
-
-                ret = C.rpc('foo', None)
-                _log.debug("RET %s", ret)
-                self.assertEqual(ret, 42)
+            ret = C.rpc('foo', None)
+            _log.debug("RET %s", ret)
+            self.assertEqual(ret, 42)
 
     def test_rpc_null(self):
-        with Server(providers=[self.provider], isolate=True) as S:
-            with Context('pva', conf=S.conf(), useenv=False) as C:
-
-                args = NTURI([
-                    ('null', '?'),
-                ])
+        with Context('pva', conf=self._conf, useenv=False) as C:
 
-                # self.pv not open()'d
-                ret = C.rpc('foo', args.wrap('foo', kws={'null':True}))
-                _log.debug("RET %s", ret)
-                self.assertIsNone(ret)
+            # self.pv not open()'d
+            ret = C.rpc('foo', self._RPC_NULL.wrap('foo', kws={'null':True}))
+            _log.debug("RET %s", ret)
+            self.assertIsNone(ret)
 
     def test_rpc_error(self):
-        with Server(providers=[self.provider], isolate=True) as S:
-            with Context('pva', conf=S.conf(), useenv=False) as C:
+        with Context('pva', conf=self._conf, useenv=False) as C:
 
-                args = NTURI([
-                    ('oops', '?'),
-                ])
-
-                with self.assertRaisesRegexp(RemoteError, 'oops'):
-                    ret = C.rpc('foo', args.wrap('foo', kws={'oops':True}))
+            with self.assertRaisesRegexp(RemoteError, 'oops'):
+                ret = C.rpc('foo', self._RPC_OOPS.wrap('foo', kws={'oops':True}))
 
 class TestRPC2(TestRPC):
     openclose = True
 
-class TestPVRequestMask(RefTestCase):
-    maxDiff = 1000
-    timeout = 1.0
-    mode = 'Mask'
+class TestPVRequestMask(SharedServerTestCase):
+    fixtures = ('sprov', 'pv')
 
     class Handler(object):
         def put(self, pv, op):
@@ -246,45 +287,30 @@ class TestPVRequestMask(RefTestCase):
             pv.post(op.value())
             op.done()
 
-    def setUp(self):
-        # gc.set_debug(gc.DEBUG_LEAK)
-        super(TestPVRequestMask, self).setUp()
-
-        self.pv = SharedPV(handler=self.Handler(),
-                           nt=NTScalar('d'),
-                           initial=1.0,
-                           options={'mapperMode':self.mode})
-        self.sprov = StaticProvider("serverend")
-        self.sprov.add('foo', self.pv)
-
-        self.server = Server(providers=[self.sprov], isolate=True)
+    @classmethod
+    def setUpFixtures(cls):
+        cls.pv = SharedPV(handler=cls.Handler(),
+                          nt=NTScalar('d'),
+                          initial=1.0)
+        cls.sprov = StaticProvider("serverend")
+        cls.sprov.add('foo', cls.pv)
+        return cls.sprov
 
     def tearDown(self):
-        self.server.stop()
-        _defaultWorkQueue.sync()
-        self.pv._handler._pv = None
-        R = [weakref.ref(r) for r in (self.server, self.sprov, self.pv, self.pv._whandler, self.pv._handler)]
-        r = None
-        del self.server
-        del self.sprov
-        del self.pv
-        gc.collect()
-        R = [r() for r in R]
-        self.assertListEqual(R, [None] * len(R))
+        # restore initial PV state for the next test
+        self.pv.close(sync=True, timeout=self.timeout)
+        self.pv.open(1.0)
         super(TestPVRequestMask, self).tearDown()
 
     def testGetPut(self):
-        with Context('pva', conf=self.server.conf(), useenv=False, unwrap={}) as ctxt:
+        with Context('pva', conf=self._conf, useenv=False, unwrap={}) as ctxt:
             V = ctxt.get('foo', request='value')
 
             self.assertEqual(V.value, 1.0)
 
             self.assertTrue(V.changed('value'))
 
-            if self.mode=='Mask':
-                self.assertSetEqual(V.changedSet(), {'value'})
-            else:
-                self.assertListEqual(V.keys(), ['value'])
+            self.assertSetEqual(V.changedSet(), {'value'})
 
             ctxt.put('foo', {'value':2.0}, request='value')
 
@@ -293,18 +319,15 @@ class TestPVRequestMask(RefTestCase):
             self.assertEqual(V.value, 2.0)
 
     def testMonitor(self):
-        with Context('pva', conf=self.server.conf(), useenv=False, unwrap={}) as ctxt:
+        with Context('pva', conf=self._conf, useenv=False, unwrap={}) as ctxt:
 
-            Q = Queue(maxsize=4)
+            Q = SimpleQueue()
             sub = ctxt.monitor('foo', Q.put, request='value')
 
             V = Q.get(timeout=self.timeout)
             self.assertEqual(V.value, 1.0)
 
-            if self.mode=='Mask':
-                self.assertSetEqual(V.changedSet(), {'value'})
-            else:
-                self.assertListEqual(V.keys(), ['value'])
+            self.assertSetEqual(V.changedSet(), {'value'})
 
             ctxt.put('foo', {'alarm.severity':1}) # should be dropped
 
@@ -313,104 +336,112 @@ class TestPVRequestMask(RefTestCase):
             V = Q.get(timeout=self.timeout)
             self.assertEqual(V.value, 3.0)
 
-            if self.mode=='Mask':
-                self.assertSetEqual(V.changedSet(), {'value'})
-            else:
-                self.assertListEqual(V.keys(), ['value'])
-
+            self.assertSetEqual(V.changedSet(), {'value'})
 
-#class TestPVRequestSlice(TestPVRequestMask):
-#    mode = 'Slice'
-
-class TestFirstLast(RefTestCase):
-    maxDiff = 1000
-    timeout = 1.0
-    mode = 'Mask'
+class TestFirstLast(SharedServerTestCase):
+    fixtures = ('sprov', 'pv', 'H')
 
     class Handler:
         def __init__(self):
-            self.evtC = threading.Event()
-            self.evtD = threading.Event()
+            self.cv = threading.Condition()
             self.conn = None
         def onFirstConnect(self, pv):
             _log.debug("onFirstConnect")
-            self.conn = True
-            self.evtC.set()
+            with self.cv:
+                self.conn = True
+                self.cv.notify_all()
         def onLastDisconnect(self, pv):
             _log.debug("onLastDisconnect")
-            self.conn = False
-            self.evtD.set()
+            with self.cv:
+                self.conn = False
+                self.cv.notify_all()
+        def wait(self, conn, timeout):
+            # Condition.wait_for() is not available with py2
+            deadline = time.time() + timeout
+            with self.cv:
+                while self.conn is not conn:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cv.wait(remaining)
+                return True
+
+    @classmethod
+    def setUpFixtures(cls):
+        cls.H = cls.Handler()
+        cls.pv = SharedPV(handler=cls.H,
+                          nt=NTScalar('d'))
+        cls.sprov = StaticProvider("serverend")
+        cls.sprov.add('foo', cls.pv)
+        return cls.sprov
 
     def setUp(self):
         super(TestFirstLast, self).setUp()
-
-        self.H = self.Handler()
-        self.pv = SharedPV(handler=self.H,
-                           nt=NTScalar('d'),
-                           options={'mapperMode':self.mode})
-        self.sprov = StaticProvider("serverend")
-        self.sprov.add('foo', self.pv)
-
-        self.server = Server(providers=[self.sprov], isolate=True)
+        with self.H.cv:
+            self.H.conn = None
 
     def tearDown(self):
-        self.server.stop()
-        _defaultWorkQueue.sync()
-        del self.server
-        del self.sprov
-        del self.pv
-        del self.H
+        self.pv.close(sync=True, timeout=self.timeout)
         super(TestFirstLast, self).tearDown()
 
+    def _waitValue(self):
+        """Returns (evt, box, cb) where monitor callback cb appends to list box,
+        and sets evt once the first Value (not Disconnected) arrives.
+        """
+        evt, box = threading.Event(), []
+        def onUpdate(V):
+            box.append(V)
+            if isinstance(V, Value):
+                evt.set()
+        return evt, box, onUpdate
+
     def testClientDisconn(self):
         self.pv.open(1.0)
 
-        with Context('pva', conf=self.server.conf(), useenv=False, unwrap={}) as ctxt:
-            Q = Queue(maxsize=4)
-            with ctxt.monitor('foo', Q.put, notify_disconnect=True):
+        with Context('pva', conf=self._conf, useenv=False, unwrap={}) as ctxt:
+            evt, box, onUpdate = self._waitValue()
+            with ctxt.monitor('foo', onUpdate, notify_disconnect=True):
 
-                self.assertIsInstance(Q.get(timeout=self.timeout), Disconnected)
-                self.assertIsInstance(Q.get(timeout=self.timeout), Value) # initial update
+                self.assertTrue(evt.wait(self.timeout)) # initial update
+                self.assertIsInstance(box[0], Disconnected)
+                self.assertIsInstance(box[1], Value)
 
                 _log.debug('TEST')
-                self.H.evtC.wait(self.timeout) # onFirstConnect()
-                self.assertTrue(self.H.conn)
+                self.assertTrue(self.H.wait(True, self.timeout)) # onFirstConnect()
 
-        self.H.evtD.wait(self.timeout) # onLastDisconnect()
+        self.assertTrue(self.H.wait(False, self.timeout)) # onLastDisconnect()
         _log.debug('SHUTDOWN')
-        self.assertFalse(self.H.conn)
 
     def testServerShutdown(self):
         self.pv.open(1.0)
 
-        with Context('pva', conf=self.server.conf(), useenv=False, unwrap={}) as ctxt:
-            Q = Queue(maxsize=4)
-            with ctxt.monitor('foo', Q.put, notify_disconnect=True):
+        # stopping the shared server would break later tests, so use a private one
+        with Server(providers=[self.sprov], isolate=True) as S:
+            with Context('pva', conf=S.conf(), useenv=False, unwrap={}) as ctxt:
+                evt, _box, onUpdate = self._waitValue()
+                with ctxt.monitor('foo', onUpdate, notify_disconnect=True):
 
-                Q.get(timeout=self.timeout) # initial update
+                    self.assertTrue(evt.wait(self.timeout)) # initial update
 
-                _log.debug('TEST')
-                self.H.evtC.wait(self.timeout) # onFirstConnect()
-                self.assertIs(self.H.conn, True)
+                    _log.debug('TEST')
+                    self.assertTrue(self.H.wait(True, self.timeout)) # onFirstConnect()
 
-                self.server.stop()
+                    S.stop()
 
-                self.H.evtD.wait(self.timeout) # onLastDisconnect()
-                _log.debug('SHUTDOWN')
-                self.assertIs(self.H.conn, False)
+                    self.assertTrue(self.H.wait(False, self.timeout)) # onLastDisconnect()
+                    _log.debug('SHUTDOWN')
 
     def testPVClose(self):
         self.pv.open(1.0)
 
-        with Context('pva', conf=self.server.conf(), useenv=False, unwrap={}) as ctxt:
-            Q = Queue(maxsize=4)
-            with ctxt.monitor('foo', Q.put, notify_disconnect=True):
+        with Context('pva', conf=self._conf, useenv=False, unwrap={}) as ctxt:
+            evt, _box, onUpdate = self._waitValue()
+            with ctxt.monitor('foo', onUpdate, notify_disconnect=True):
 
-                Q.get(timeout=self.timeout) # initial update
+                self.assertTrue(evt.wait(self.timeout)) # initial update
 
                 _log.debug('TEST')
-                self.H.evtC.wait(self.timeout) # onFirstConnect()
-                self.assertTrue(self.H.conn)
+                self.assertTrue(self.H.wait(True, self.timeout)) # onFirstConnect()
 
                 self.pv.close(destroy=True, sync=True, timeout=self.timeout) # onLastDisconnect()
 
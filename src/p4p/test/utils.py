@@ -58,6 +58,9 @@ class RefTestMixin(object):
     """
     # set to list of names to compare.  Set to None to disable
     ref_check = ('*',)
+    # seconds to wait for counts to return to their initial values.
+    # Set when a Server outlives each test, as it releases per-connection objects asynchronously.
+    ref_settle = 0.0
 
     def __refs(self, refs=None):
         refs = refs or listRefs()
@@ -92,6 +95,12 @@ class RefTestMixin(object):
             gc.collect()
             after = self.__refs()
 
+            deadline = time.time() + self.ref_settle
+            while after != self.__before and time.time() < deadline:
+                self._sleep(0.01)
+                gc.collect()
+                after = self.__refs()
+
             test = self.__before == after
 
             for mustzero in ('ClientContextImpl',):
@@ -137,6 +146,26 @@ class RefTestCase(RefTestMixin, unittest.TestCase):
     def tearDown(self):
         super(RefTestCase, self).tearDown()
 
+    @classmethod
+    def _assertReleased(klass, names, *objs):
+        """Delete the named class attributes, then check that these, and any other objs, are free'd.
+
+        Only falls back to gc.collect() if reference counting alone was not enough.
+        """
+        # weakref callbacks record each release as it happens.  (no weakref.finalize() with py2)
+        freed = []
+        R = [weakref.ref(getattr(klass, name), freed.append) for name in names]
+        R += [weakref.ref(obj, freed.append) for obj in objs]
+        objs = None
+        for name in names:
+            delattr(klass, name)
+
+        if len(freed) != len(R):
+            gc.collect()
+
+        if len(freed) != len(R):
+            raise AssertionError("Not released: %s" % [r() for r in R if r not in freed])
+
     if not hasattr(unittest.TestCase, 'assertRegex'):
         def assertRegex(self, text, regex):
             import re